@@ -3,20 +3,60 @@ MCP Server for Bitcoin Lightning SMS Payments
 Smithery-compatible version
 """
 
+import asyncio
+import hashlib
+import hmac
+import html
+import itertools
+import json
+import re
+import secrets
+import string
+import struct
+import time
+import zlib
+from collections.abc import Mapping
+from dataclasses import dataclass, field
 from urllib.parse import quote
-from io import BytesIO
 from typing import Any
 
 import httpx
-import qrcode
+import orjson
+import segno
+from cachetools import TLRUCache
+from twilio.http.async_http_client import AsyncTwilioHttpClient
 from twilio.rest import Client as TwilioClient
 from pydantic import BaseModel, Field
+from starlette.requests import Request
+from starlette.responses import Response
 
 from mcp.server.fastmcp import Context, FastMCP, Image
 from mcp.server.session import ServerSession
 from smithery.decorators import smithery
 
 
+OPENNODE_API_URL = "https://api.opennode.com/v1"
+# Headers shared by every OpenNode request; only Authorization varies per session
+OPENNODE_STATIC_HEADERS = {"Content-Type": "application/json"}
+OPENNODE_WEBHOOK_PATH = "/opennode/webhook"
+# How long pay_and_send_sms waits for the webhook before polling OpenNode
+PAYMENT_WAIT_SECONDS = 5.0
+# Upper bound on one Twilio send; it runs under the charge's send_lock
+TWILIO_TIMEOUT_SECONDS = 15.0
+
+# E.164: '+', country code without leading zero, 8-15 ASCII digits in total
+E164_PATTERN = re.compile(r"\+[1-9][0-9]{7,14}")
+
+# Upper bound on tracked SMS requests; soonest-to-expire entries are dropped first
+PENDING_MAX_ENTRIES = 10_000
+# Keep an entry this long past invoice expiry so a last-second payment still sends
+PENDING_GRACE_SECONDS = 15 * 60
+# Keep paid-but-unsent entries this long so the payer can still get their SMS
+PAID_TTL_SECONDS = 24 * 60 * 60
+# Keep completed entries this long so retries still get "already sent"
+COMPLETED_TTL_SECONDS = 10 * 60
+
+
 # Configuration schema for session-specific settings
 class ConfigSchema(BaseModel):
     opennode_api_key: str = Field(..., description="OpenNode API key for Lightning payments")
@@ -24,6 +64,140 @@ class ConfigSchema(BaseModel):
     twilio_auth_token: str = Field(..., description="Twilio Auth Token")
     twilio_phone_number: str = Field(..., description="Twilio phone number (E.164 format)")
     sms_price_usd: float = Field(0.10, description="Price per SMS in USD")
+    callback_base_url: str | None = Field(
+        None, description="Public base URL of this server; enables OpenNode payment webhooks"
+    )
+    verbose_logging: bool = Field(False, description="Send per-step progress logs to the client")
+
+
+@dataclass(slots=True)
+class SmsRequest:
+    """An SMS waiting for its Lightning charge to be paid."""
+    user_id: str
+    phone_number: str
+    message: str
+    amount: float
+    lightning_invoice: str
+    hosted_checkout_url: str
+    expires_at: float
+    created_at: int | None = None
+    paid_at: int | None = None
+    # Local time payment was first observed, via webhook or poll
+    paid_seen_at: float | None = None
+    status: str = "pending"
+    sent: bool = False
+    sms_sid: str | None = None
+    completed_at: float | None = None
+    # Expected hashed_order of OpenNode callbacks; None when webhooks are off
+    callback_hash: str | None = None
+    # SHA-256 of the creating session's OpenNode API key; gates local shortcuts
+    owner_key_digest: bytes = b""
+    paid_event: asyncio.Event = field(default_factory=asyncio.Event)
+    # Serialises the check-send-mark sequence so one payment sends one SMS
+    send_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Last GET /charge/{id} body and its ETag, for conditional re-polls
+    charge: dict[str, Any] | None = None
+    charge_etag: str | None = None
+    # Rendered invoice QR code, kept until the SMS is sent
+    qr_png: bytes | None = None
+
+
+def sms_request_expiry(charge_id: str, request: SmsRequest, now: float) -> float:
+    """Absolute time at which a pending_sms entry is evicted."""
+    if request.completed_at is not None:
+        return request.completed_at + COMPLETED_TTL_SECONDS
+    if request.paid_seen_at is not None:
+        return request.paid_seen_at + PAID_TTL_SECONDS
+    return request.expires_at + PENDING_GRACE_SECONDS
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def encode_qr_png(matrix: list[list[bool]], scale: int) -> bytes:
+    """Encode a QR module matrix as a 1-bit greyscale PNG, dark modules black."""
+    size = len(matrix) * scale
+    padding = "1" * (-size % 8)
+    row_bytes = (size + len(padding)) // 8
+
+    scanlines = bytearray()
+    for row in matrix:
+        bits = "".join(("0" if dark else "1") * scale for dark in row) + padding
+        # Filter type 0 per scanline, each module row repeated `scale` times
+        scanlines += (b"\x00" + int(bits, 2).to_bytes(row_bytes, "big")) * scale
+
+    header = struct.pack(">IIBBBBB", size, size, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(bytes(scanlines)))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def _qr_png_bytes(data: str) -> bytes:
+    """Render data as a QR code PNG."""
+    # Bech32 is case-insensitive; uppercase lets the encoder use the denser
+    # alphanumeric mode instead of 8-bit bytes (e.g. version 13 -> 10)
+    qr = segno.make(data.upper(), error="q", micro=False)
+    matrix = [list(row) for row in qr.matrix_iter(scale=1, border=4)]
+    return encode_qr_png(matrix, scale=12)
+
+
+# Mobile checkout page, compiled once; filled in by render_mobile_html()
+MOBILE_HTML_TEMPLATE = string.Template("""
+        <!doctype html>
+        <html>
+          <head>
+            <meta name="viewport" content="width=device-width,initial-scale=1"/>
+            <title>Pay with Lightning</title>
+            <script>
+              function openWallet() {
+                window.location = $deep_link_js;
+                setTimeout(function() {
+                  $fallback_js
+                }, 1200);
+              }
+              window.addEventListener('load', function() {
+                openWallet();
+              });
+            </script>
+            <style>body { font-family: sans-serif; text-align:center; padding:20px; }</style>
+          </head>
+          <body>
+            <h2>Pay with Lightning</h2>
+            <p>Tap the button below if your wallet didn't open automatically.</p>
+            <p><a href="$deep_link" style="display:inline-block;padding:12px 18px;background:#111;color:#fff;border-radius:8px;text-decoration:none;">Open wallet</a></p>
+            <div id="fallback" style="display:none;">
+              <p>If your wallet doesn't open, use this link:</p>
+              <p><a href="$fallback_url">$fallback_url</a></p>
+            </div>
+            <hr/>
+            <p style="font-size:0.85em;color:#666;">Or scan the QR code shown by the app.</p>
+          </body>
+        </html>
+        """)
+SHOW_FALLBACK_JS = "document.getElementById('fallback').style.display='block';"
+
+
+def js_string(value: str) -> str:
+    """Quote value as a JavaScript string literal that is safe inside <script>."""
+    return json.dumps(value).replace("</", "<\\/")
+
+
+def render_mobile_html(deep_link: str, hosted_checkout: str | None) -> str:
+    """Render the mobile checkout page; falls back to hosted checkout if the wallet doesn't open."""
+    if hosted_checkout:
+        fallback_js = f"window.location = {js_string(hosted_checkout)};"
+    else:
+        fallback_js = SHOW_FALLBACK_JS
+    return MOBILE_HTML_TEMPLATE.substitute(
+        deep_link=html.escape(deep_link),
+        deep_link_js=js_string(deep_link),
+        fallback_js=fallback_js,
+        fallback_url=html.escape(hosted_checkout or deep_link),
+    )
 
 
 @smithery.server(config_schema=ConfigSchema)
@@ -35,39 +209,174 @@ def create_server():
         instructions="Simple pay-per-SMS: Create charge, scan QR, pay, send SMS"
     )
 
-    # Store SMS requests awaiting payment: charge_id -> request_info
-    pending_sms: dict[str, dict[str, Any]] = {}
+    # Shared OpenNode client so every tool call reuses pooled keep-alive connections
+    http_client = httpx.AsyncClient(
+        base_url=OPENNODE_API_URL,
+        headers=OPENNODE_STATIC_HEADERS,
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0),
+        # http2/limits must live on the transport once one is passed explicitly
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=128,
+                keepalive_expiry=90.0,
+            ),
+            retries=2,
+        ),
+    )
 
-    def get_opennode_headers(ctx: Context) -> dict[str, str]:
-        """Get headers for OpenNode API requests."""
-        api_key = ctx.session_config.opennode_api_key
+    # Store SMS requests awaiting payment: charge_id -> request_info.
+    # Entries expire with their invoice (or shortly after completion).
+    pending_sms: TLRUCache[str, SmsRequest] = TLRUCache(
+        maxsize=PENDING_MAX_ENTRIES,
+        ttu=sms_request_expiry,
+        timer=time.time,
+    )
+    # Unique order_id suffixes; independent of pending_sms size and eviction.
+    # The random run token keeps IDs unique across restarts, when the count resets.
+    order_run = secrets.token_hex(4)
+    order_seq = itertools.count()
+
+    # In-flight GET /charge/{id} lookups keyed by (api_key, charge_id)
+    inflight_charges: dict[tuple[str, str], asyncio.Task[dict[str, Any]]] = {}
+
+    async def request_charge(
+        charge_id: str, headers: dict[str, str], sms_request: SmsRequest
+    ) -> dict[str, Any]:
+        if sms_request.charge_etag is not None:
+            headers = {**headers, "If-None-Match": sms_request.charge_etag}
+
+        response = await http_client.get(f"/charge/{charge_id}", headers=headers)
+        # Unchanged since the last poll: no body to download or decode
+        if response.status_code == httpx.codes.NOT_MODIFIED and sms_request.charge is not None:
+            return sms_request.charge
+        response.raise_for_status()
+
+        charge = orjson.loads(response.content)
+        etag = response.headers.get("etag")
+        if etag is not None:
+            sms_request.charge = charge
+            sms_request.charge_etag = etag
+        return charge
+
+    async def fetch_charge(ctx: Context, charge_id: str, sms_request: SmsRequest) -> dict[str, Any]:
+        """Fetch a charge from OpenNode, sharing one request among concurrent callers."""
+        headers = get_opennode_headers(ctx)
+        key = (headers["Authorization"], charge_id)
+        task = inflight_charges.get(key)
+        if task is None:
+            task = asyncio.create_task(request_charge(charge_id, headers, sms_request))
+            inflight_charges[key] = task
+            task.add_done_callback(lambda _: inflight_charges.pop(key, None))
+        # Shield so one cancelled caller doesn't cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    async def wait_for_payment(sms_request: SmsRequest) -> bool:
+        """Wait briefly for the OpenNode webhook to report the charge as paid."""
+        if sms_request.callback_hash is None:
+            return False
+        try:
+            await asyncio.wait_for(sms_request.paid_event.wait(), timeout=PAYMENT_WAIT_SECONDS)
+        except TimeoutError:
+            return False
+        return True
+
+    def verbose(ctx: Context | None) -> bool:
+        """Whether the session asked for per-step progress logs (errors are always sent)."""
+        return ctx is not None and getattr(ctx.session_config, "verbose_logging", False)
+
+    def already_sent_result(charge_id: str) -> dict[str, Any]:
+        """pay_and_send_sms result for a charge whose SMS already went out."""
         return {
-            "Authorization": api_key,
-            "Content-Type": "application/json"
+            "charge_id": charge_id,
+            "status": "completed",
+            "paid": True,
+            "sms_sent": True,
+            "message": "SMS already sent for this payment"
         }
 
-    def get_twilio_client(ctx: Context) -> TwilioClient:
-        """Initialize Twilio client."""
-        config = ctx.session_config
-        return TwilioClient(config.twilio_account_sid, config.twilio_auth_token)
-
-    def generate_qr_code(data: str) -> Image:
-        qr = qrcode.QRCode(
-            version=None,
-            error_correction=qrcode.constants.ERROR_CORRECT_Q,
-            box_size=12,
-            border=4,
+    def record_payment(charge_id: str, sms_request: SmsRequest) -> None:
+        """Mark a charge as paid the first time payment is observed."""
+        if sms_request.paid_seen_at is not None:
+            return
+        if sms_request.status == "pending":
+            sms_request.status = "paid"
+        sms_request.paid_seen_at = time.time()
+        # Webhook payments may never read the charge; report when we saw it paid
+        if sms_request.paid_at is None:
+            sms_request.paid_at = int(sms_request.paid_seen_at)
+        # Re-insert so the entry picks up the longer paid TTL
+        pending_sms[charge_id] = sms_request
+
+    def send_unknown_result(charge_id: str) -> dict[str, Any]:
+        """pay_and_send_sms result for a charge whose send timed out mid-request."""
+        return {
+            "charge_id": charge_id,
+            "status": "send_unknown",
+            "paid": True,
+            "sms_sent": None,
+            "message": "SMS send timed out and may have been delivered; not resending automatically"
+        }
+
+    def api_key_digest(ctx: Context) -> bytes:
+        """Digest of the session's OpenNode API key, for owner checks."""
+        return hashlib.sha256(ctx.session_config.opennode_api_key.encode()).digest()
+
+    def owns_request(ctx: Context | None, sms_request: SmsRequest) -> bool:
+        """Whether the session created this request with the same OpenNode API key.
+
+        pending_sms is shared by every session in the process; the OpenNode GET is
+        the only other proof that a caller may see a charge.
+        """
+        return ctx is not None and hmac.compare_digest(
+            api_key_digest(ctx), sms_request.owner_key_digest
         )
-        qr.add_data(data)
-        qr.make(fit=True)
 
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        return Image(data=buffer.getvalue(), format="png")
+    # Per-API-key request headers, built once; treat as read-only and copy to extend
+    opennode_headers: dict[str, dict[str, str]] = {}
+
+    def get_opennode_headers(ctx: Context) -> dict[str, str]:
+        """Get per-session headers for OpenNode API requests."""
+        api_key = ctx.session_config.opennode_api_key
+        headers = opennode_headers.get(api_key)
+        if headers is None:
+            headers = opennode_headers[api_key] = {"Authorization": api_key}
+        return headers
+
+    # One Twilio client per credential pair, never evicted: dropping one would
+    # leave its aiohttp session (and sockets) unclosed
+    twilio_clients: dict[tuple[str, str], TwilioClient] = {}
+
+    def get_twilio_client(ctx: Context) -> TwilioClient:
+        """Get the Twilio client for the session's credentials, reusing its connection pool.
+
+        Must be called from the running event loop: the async HTTP client opens
+        its aiohttp session on construction.
+        """
+        config = ctx.session_config
+        key = (config.twilio_account_sid, config.twilio_auth_token)
+        client = twilio_clients.get(key)
+        if client is None:
+            client = twilio_clients[key] = TwilioClient(
+                *key, http_client=AsyncTwilioHttpClient()
+            )
+        return client
+
+    async def generate_qr_code(sms_request: SmsRequest) -> Image:
+        """QR code for the request's invoice; rendered once, in a worker thread."""
+        if sms_request.qr_png is None:
+            # Encoding is CPU-bound; keep the event loop free for other sessions
+            sms_request.qr_png = await asyncio.to_thread(
+                _qr_png_bytes, sms_request.lightning_invoice
+            )
+        return Image(data=sms_request.qr_png, format="png")
 
     def generate_lightning_deep_link(invoice: str) -> str:
         """Returns a deep link using the lightning: URI scheme."""
+        # Bech32 invoices are plain ASCII alphanumerics and need no escaping
+        if invoice.isascii() and invoice.isalnum():
+            return "lightning:" + invoice
         return f"lightning:{quote(invoice, safe='')}"
 
     @mcp.tool()
@@ -89,46 +398,61 @@ def create_server():
         Returns:
             Payment details with charge_id for QR generation
         """
-        if ctx:
+        # Reject bad numbers before creating a charge Twilio could never deliver
+        if not E164_PATTERN.fullmatch(phone_number):
+            raise ValueError("phone_number must be in E.164 format, e.g. +1234567890")
+
+        if verbose(ctx):
             await ctx.info(f"Creating SMS payment for {phone_number}")
 
         try:
-            price = ctx.session_config.sms_price_usd
+            config = ctx.session_config
+            price = config.sms_price_usd
 
             payload = {
                 "amount": price,
                 "currency": "USD",
                 "description": f"SMS to {phone_number}",
                 "auto_settle": False,
-                "order_id": f"sms-{user_id}-{len(pending_sms)}"
+                "order_id": f"sms-{user_id}-{order_run}-{next(order_seq)}"
             }
-
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.opennode.com/v1/charges",
-                    json=payload,
-                    headers=get_opennode_headers(ctx),
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                charge = response.json()
+            if config.callback_base_url:
+                payload["callback_url"] = config.callback_base_url.rstrip("/") + OPENNODE_WEBHOOK_PATH
+
+            # Content-Type: application/json comes from the client's static headers
+            response = await http_client.post(
+                "/charges",
+                content=orjson.dumps(payload),
+                headers=get_opennode_headers(ctx)
+            )
+            response.raise_for_status()
+            charge = orjson.loads(response.content)
 
             charge_id = charge["data"]["id"]
             lightning_invoice = charge["data"]["lightning_invoice"]["payreq"]
 
-            pending_sms[charge_id] = {
-                "user_id": user_id,
-                "phone_number": phone_number,
-                "message": message,
-                "amount": price,
-                "lightning_invoice": lightning_invoice,
-                "hosted_checkout_url": charge["data"]["hosted_checkout_url"],
-                "status": "pending",
-                "sent": False
-            }
+            callback_hash = None
+            if config.callback_base_url:
+                # OpenNode signs callbacks with HMAC-SHA256(api_key, charge_id)
+                callback_hash = hmac.new(
+                    config.opennode_api_key.encode(), charge_id.encode(), hashlib.sha256
+                ).hexdigest()
+
+            pending_sms[charge_id] = SmsRequest(
+                user_id=user_id,
+                phone_number=phone_number,
+                message=message,
+                amount=price,
+                lightning_invoice=lightning_invoice,
+                hosted_checkout_url=charge["data"]["hosted_checkout_url"],
+                expires_at=float(charge["data"]["lightning_invoice"]["expires_at"]),
+                created_at=charge["data"].get("created_at"),
+                callback_hash=callback_hash,
+                owner_key_digest=api_key_digest(ctx)
+            )
 
             if ctx:
-                await ctx.info(f"Payment created: {charge_id}")
+                await ctx.info(f"Payment created: {charge_id} for {phone_number}")
 
             return {
                 "charge_id": charge_id,
@@ -165,14 +489,13 @@ def create_server():
         Returns:
             QR code image to scan with Lightning wallet
         """
-        if ctx:
+        if verbose(ctx):
             await ctx.info(f"Generating QR for {charge_id}")
 
         if charge_id not in pending_sms:
             raise ValueError(f"Charge {charge_id} not found")
 
-        lightning_invoice = pending_sms[charge_id]["lightning_invoice"]
-        return generate_qr_code(lightning_invoice)
+        return await generate_qr_code(pending_sms[charge_id])
 
     @mcp.tool()
     async def get_sms_qr_with_link(
@@ -183,49 +506,18 @@ def create_server():
         Return QR image plus mobile-friendly deep link and HTML fallback.
         Useful for mobile webviews or clients that can render HTML.
         """
-        if ctx:
+        if verbose(ctx):
             await ctx.info(f"Generating QR + link for {charge_id}")
 
         if charge_id not in pending_sms:
             raise ValueError(f"Charge {charge_id} not found")
 
         data = pending_sms[charge_id]
-        invoice = data["lightning_invoice"]
-        hosted_checkout = data.get("hosted_checkout_url", None)
+        invoice = data.lightning_invoice
+        hosted_checkout = data.hosted_checkout_url
         deep_link = generate_lightning_deep_link(invoice)
 
-        html_snippet = f"""
-        <!doctype html>
-        <html>
-          <head>
-            <meta name="viewport" content="width=device-width,initial-scale=1"/>
-            <title>Pay with Lightning</title>
-            <script>
-              function openWallet() {{
-                window.location = "{deep_link}";
-                setTimeout(function() {{
-                  {"window.location = %s;" % ("'" + hosted_checkout + "'") if hosted_checkout else "document.getElementById('fallback').style.display='block';"}
-                }}, 1200);
-              }}
-              window.addEventListener('load', function() {{
-                openWallet();
-              }});
-            </script>
-            <style>body {{ font-family: sans-serif; text-align:center; padding:20px; }}</style>
-          </head>
-          <body>
-            <h2>Pay with Lightning</h2>
-            <p>Tap the button below if your wallet didn't open automatically.</p>
-            <p><a href="{deep_link}" style="display:inline-block;padding:12px 18px;background:#111;color:#fff;border-radius:8px;text-decoration:none;">Open wallet</a></p>
-            <div id="fallback" style="display:none;">
-              <p>If your wallet doesn't open, use this link:</p>
-              <p><a href="{hosted_checkout if hosted_checkout else deep_link}">{hosted_checkout if hosted_checkout else deep_link}</a></p>
-            </div>
-            <hr/>
-            <p style="font-size:0.85em;color:#666;">Or scan the QR code shown by the app.</p>
-          </body>
-        </html>
-        """
+        html_snippet = render_mobile_html(deep_link, hosted_checkout)
 
         return {
             "deep_link": deep_link,
@@ -248,24 +540,28 @@ def create_server():
         Returns:
             Payment status and SMS delivery result
         """
-        if ctx:
+        if verbose(ctx):
             await ctx.info(f"Checking payment for {charge_id}")
 
         if charge_id not in pending_sms:
             raise ValueError(f"Charge {charge_id} not found")
 
+        sms_request = pending_sms[charge_id]
+        # Other sessions must prove access through OpenNode before anything local
+        owner = owns_request(ctx, sms_request)
+        # Idempotent retry: nothing OpenNode can tell us changes the outcome
+        if owner and sms_request.sent:
+            return already_sent_result(charge_id)
+        if owner and sms_request.status == "send_unknown":
+            return send_unknown_result(charge_id)
+
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"https://api.opennode.com/v1/charge/{charge_id}",
-                    headers=get_opennode_headers(ctx),
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                charge = response.json()
-
-            status = charge["data"]["status"]
-            sms_request = pending_sms[charge_id]
+            if owner and await wait_for_payment(sms_request):
+                status = "paid"
+            else:
+                charge = await fetch_charge(ctx, charge_id, sms_request)
+                status = charge["data"]["status"]
+                sms_request.paid_at = charge["data"].get("paid_at")
 
             if status != "paid":
                 return {
@@ -275,43 +571,58 @@ def create_server():
                     "sms_sent": False,
                     "message": f"Payment not received yet (status: {status})"
                 }
+            record_payment(charge_id, sms_request)
+
+            async with sms_request.send_lock:
+                # A concurrent call may have sent it while we awaited OpenNode
+                if sms_request.sent:
+                    return already_sent_result(charge_id)
+                if sms_request.status == "send_unknown":
+                    return send_unknown_result(charge_id)
 
-            if not sms_request["sent"]:
                 twilio = get_twilio_client(ctx)
                 from_number = ctx.session_config.twilio_phone_number
 
-                sms = twilio.messages.create(
-                    body=sms_request["message"],
-                    from_=from_number,
-                    to=sms_request["phone_number"]
-                )
-
-                pending_sms[charge_id]["sent"] = True
-                pending_sms[charge_id]["status"] = "completed"
-                pending_sms[charge_id]["sms_sid"] = sms.sid
+                # The async HTTP client doesn't apply any timeout to requests
+                try:
+                    sms = await asyncio.wait_for(
+                        twilio.messages.create_async(
+                            body=sms_request.message,
+                            from_=from_number,
+                            to=sms_request.phone_number
+                        ),
+                        timeout=TWILIO_TIMEOUT_SECONDS
+                    )
+                except TimeoutError:
+                    # The POST may already have reached Twilio; a resend could
+                    # deliver (and bill) the message twice
+                    sms_request.status = "send_unknown"
+                    if ctx:
+                        await ctx.error(f"Twilio send timed out for {charge_id}; outcome unknown")
+                    return send_unknown_result(charge_id)
+
+                sms_request.sent = True
+                sms_request.status = "completed"
+                sms_request.sms_sid = sms.sid
+                sms_request.completed_at = time.time()
+                sms_request.qr_png = None
+                # Re-insert so the entry picks up the shorter completed TTL
+                pending_sms[charge_id] = sms_request
 
-                if ctx:
-                    await ctx.info(f"SMS sent successfully: {sms.sid}")
+            if ctx:
+                await ctx.info(f"SMS sent successfully: {sms.sid}")
 
-                return {
-                    "charge_id": charge_id,
-                    "status": "completed",
-                    "paid": True,
-                    "sms_sent": True,
-                    "sms_sid": sms.sid,
-                    "to": sms_request["phone_number"],
-                    "from": from_number,
-                    "paid_at": charge["data"].get("paid_at"),
-                    "message": "Payment received and SMS sent successfully!"
-                }
-            else:
-                return {
-                    "charge_id": charge_id,
-                    "status": "completed",
-                    "paid": True,
-                    "sms_sent": True,
-                    "message": "SMS already sent for this payment"
-                }
+            return {
+                "charge_id": charge_id,
+                "status": "completed",
+                "paid": True,
+                "sms_sent": True,
+                "sms_sid": sms.sid,
+                "to": sms_request.phone_number,
+                "from": from_number,
+                "paid_at": sms_request.paid_at,
+                "message": "Payment received and SMS sent successfully!"
+            }
 
         except httpx.HTTPStatusError as e:
             error_msg = f"OpenNode API error: {e.response.status_code} - {e.response.text}"
@@ -342,24 +653,37 @@ def create_server():
 
         sms_request = pending_sms[charge_id]
 
+        # Paid per the webhook, or already completed: OpenNode has nothing new to say.
+        # Only the creating session may skip the GET that authorises the lookup.
+        if owns_request(ctx, sms_request) and (
+            sms_request.sent or sms_request.paid_event.is_set()
+        ):
+            return {
+                "charge_id": charge_id,
+                "payment_status": "paid",
+                "sms_sent": sms_request.sent,
+                "sms_status": sms_request.status,
+                "phone_number": sms_request.phone_number,
+                "amount": sms_request.amount,
+                "created_at": sms_request.created_at,
+                "paid_at": sms_request.paid_at
+            }
+
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"https://api.opennode.com/v1/charge/{charge_id}",
-                    headers=get_opennode_headers(ctx),
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                charge = response.json()
+            charge = await fetch_charge(ctx, charge_id, sms_request)
+            sms_request.paid_at = charge["data"].get("paid_at")
+            if charge["data"]["status"] == "paid":
+                record_payment(charge_id, sms_request)
 
             return {
                 "charge_id": charge_id,
                 "payment_status": charge["data"]["status"],
-                "sms_sent": sms_request["sent"],
-                "phone_number": sms_request["phone_number"],
-                "amount": sms_request["amount"],
+                "sms_sent": sms_request.sent,
+                "sms_status": sms_request.status,
+                "phone_number": sms_request.phone_number,
+                "amount": sms_request.amount,
                 "created_at": charge["data"]["created_at"],
-                "paid_at": charge["data"].get("paid_at")
+                "paid_at": sms_request.paid_at
             }
 
         except Exception as e:
@@ -367,6 +691,42 @@ def create_server():
                 await ctx.error(f"Error: {str(e)}")
             raise
 
+    @mcp.custom_route(OPENNODE_WEBHOOK_PATH, methods=["POST"])
+    async def opennode_webhook(request: Request) -> Response:
+        """Receive OpenNode charge callbacks and wake pay_and_send_sms waiters."""
+        if request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                data = orjson.loads(await request.body())
+            except orjson.JSONDecodeError:
+                return Response(status_code=400)
+        else:
+            data = await request.form()
+
+        # Public, unauthenticated route: only a JSON object or form body is a callback
+        if not isinstance(data, Mapping):
+            return Response(status_code=400)
+
+        charge_id = str(data.get("id", ""))
+        sms_request = pending_sms.get(charge_id)
+        if sms_request is None or sms_request.callback_hash is None:
+            return Response(status_code=404)
+
+        # Compare bytes: compare_digest raises TypeError on non-ASCII str input
+        hashed_order = str(data.get("hashed_order", "")).encode()
+        if not hmac.compare_digest(hashed_order, sms_request.callback_hash.encode()):
+            return Response(status_code=403)
+
+        if data.get("status") == "paid":
+            # Prefer OpenNode's own payment time when the callback carries it
+            try:
+                sms_request.paid_at = int(data.get("paid_at"))
+            except (TypeError, ValueError):
+                pass
+            record_payment(charge_id, sms_request)
+            sms_request.paid_event.set()
+
+        return Response(status_code=200)
+
     @mcp.resource("sms://instructions")
     def instructions() -> str:
         """Instructions for using the SMS service."""